@@ -1,15 +1,23 @@
 import os
 import math
+import hashlib
+import functools
+import orjson
+import threading
+import time
 import requests
 from io import BytesIO
+from concurrent.futures import Future, ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
 from PIL import Image
-from flask import Flask, request, jsonify, session, send_file
+from flask import Flask, Response, request, jsonify, session
+from flask.json.provider import DefaultJSONProvider
 from flask_session import Session
 from flask_cors import CORS
-from google.oauth2 import id_token
-from google.auth.transport import requests as google_requests
+from flask_caching import Cache
+from google.auth import jwt as google_jwt
 from werkzeug.middleware.proxy_fix import ProxyFix
-from pymongo import MongoClient
+from pymongo import MongoClient, ReturnDocument
 from dotenv import load_dotenv
 
 # Load environment variables
@@ -17,6 +25,20 @@ load_dotenv()
 
 app = Flask(__name__)
 
+class OrjsonProvider(DefaultJSONProvider):
+    """JSON provider backed by orjson, which also serializes ObjectIds as strings."""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=str, option=orjson.OPT_NON_STR_KEYS).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+app.json = OrjsonProvider(app)
+
+# Debug output stays off unless LOG_LEVEL=DEBUG
+app.logger.setLevel(os.getenv("LOG_LEVEL", "INFO").upper())
+
 # Fix proxy configuration
 app.wsgi_app = ProxyFix(app.wsgi_app, x_proto=1, x_host=1)
 
@@ -54,32 +76,155 @@ def after_request(response):
 # 3) MONGODB CONNECTION
 # -----------------------------
 try:
-    client = MongoClient(os.getenv("MONGO_URI"))
+    # One bounded pool per process, shared by every route. connect=False defers
+    # the first connection so a forked worker never reuses the parent's sockets.
+    client = MongoClient(
+        os.getenv("MONGO_URI"),
+        maxPoolSize=50,
+        minPoolSize=5,
+        maxIdleTimeMS=60000,
+        waitQueueTimeoutMS=2500,
+        serverSelectionTimeoutMS=3000,
+        connect=False
+    )
     db = client[os.getenv("MONGO_DB_NAME")]
-    print("Connected to MongoDB")
+    app.logger.info("MongoDB client configured")
 except Exception as e:
-    print("Failed to connect to MongoDB:", str(e))
+    app.logger.error("Failed to connect to MongoDB: %s", e)
 
 # Collections
 users_collection = db["users"]
 watchlists_collection = db["watchlists"]
 journals_collection = db["journals"]
 
+# List endpoints return everything, so fetch it in as few round-trips as possible
+# (the server default stops the first batch at 101 documents)
+LIST_BATCH_SIZE = 500
+
+def create_indexes():
+    """
+    Creates the indexes for the per-user lookups every route makes.
+    Called once per process at startup rather than at import, so that a
+    preloading server never opens connections before forking.
+    """
+    try:
+        users_collection.create_index("email", unique=True)
+        watchlists_collection.create_index([("user_email", 1), ("name", 1)], unique=True)
+        journals_collection.create_index([("user_email", 1), ("date", -1)])
+        app.logger.info("Connected to MongoDB")
+    except Exception as e:
+        app.logger.error("Failed to create MongoDB indexes: %s", e)
+
+class BatchLoader:
+    """
+    Coalesces lookups of a user's watchlists by name that arrive within a short
+    window (e.g. a page loading several lists and covers at once) into a single
+    `{"name": {"$in": [...]}}` query, and hands each caller its own document.
+    """
+
+    def __init__(self, fetch, window=0.005, timeout=10):
+        # fetch(user_email, names) -> iterable of documents that include "name"
+        self.fetch = fetch
+        self.window = window
+        # Upper bound on waiting for a batch, so a stuck query can't hang requests
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._pending = {}
+
+    def load(self, user_email, name):
+        """Returns the user's watchlist document with this name, or None."""
+        future = Future()
+        with self._lock:
+            batch = self._pending.get(user_email)
+            if batch is None:
+                # Start the timer before publishing the batch, so a failed start
+                # can't leave a batch behind that nothing will ever dispatch.
+                # The timer can't dispatch early, as _dispatch waits on the lock.
+                timer = threading.Timer(self.window, self._dispatch, (user_email,))
+                timer.daemon = True
+                timer.start()
+                batch = self._pending[user_email] = {}
+            batch.setdefault(name, []).append(future)
+        return future.result(timeout=self.timeout)
+
+    def _dispatch(self, user_email):
+        with self._lock:
+            batch = self._pending.pop(user_email)
+
+        try:
+            docs = {doc["name"]: doc for doc in self.fetch(user_email, list(batch))}
+        except Exception as e:
+            for futures in batch.values():
+                for future in futures:
+                    future.set_exception(e)
+            return
+
+        for name, futures in batch.items():
+            for future in futures:
+                future.set_result(docs.get(name))
+
+watchlist_loader = BatchLoader(
+    lambda user_email, names: watchlists_collection.find(
+        {"user_email": user_email, "name": {"$in": names}}
+    )
+)
+# Covers only need the first 4 poster paths, so let MongoDB pick them out
+cover_loader = BatchLoader(
+    lambda user_email, names: watchlists_collection.aggregate([
+        {"$match": {"user_email": user_email, "name": {"$in": names}}},
+        {"$project": {
+            "_id": 0,
+            "name": 1,
+            "posters": {"$map": {
+                "input": {"$slice": [{"$ifNull": ["$movies", []]}, 4]},
+                "in": {"$ifNull": ["$$this.poster_path", None]}
+            }}
+        }}
+    ])
+)
+
 # -----------------------------
 # 4) GOOGLE OAUTH
 # -----------------------------
 GOOGLE_CLIENT_ID = os.getenv("GOOGLE_CLIENT_ID")
+GOOGLE_CERTS_URL = "https://www.googleapis.com/oauth2/v1/certs"
+GOOGLE_CERTS_TTL = 3600
+GOOGLE_CERTS_MIN_REFRESH = 60  # Unknown key ids can't force a re-fetch more often than this
+GOOGLE_ISSUERS = ("accounts.google.com", "https://accounts.google.com")
+
+# Google's signing certs, kept in memory so logins verify without a network call
+_google_certs = {"certs": {}, "fetched_at": 0}
+_google_certs_lock = threading.Lock()
+
+def get_google_certs(key_id=None):
+    """
+    Returns Google's OAuth public certs, keyed by key id. They are re-fetched
+    once an hour, or early when a token is signed with a key we don't have yet.
+    """
+    with _google_certs_lock:
+        age = time.time() - _google_certs["fetched_at"]
+        unknown_key = key_id not in _google_certs["certs"]
+        if age >= GOOGLE_CERTS_TTL or (unknown_key and age >= GOOGLE_CERTS_MIN_REFRESH):
+            response = requests.get(GOOGLE_CERTS_URL, timeout=10)
+            response.raise_for_status()
+            _google_certs["certs"] = response.json()
+            _google_certs["fetched_at"] = time.time()
+        return _google_certs["certs"]
+
+def verify_google_token(token):
+    """Verifies a Google ID token locally against the cached certs and returns its claims."""
+    key_id = google_jwt.decode_header(token).get("kid")
+    idinfo = google_jwt.decode(token, certs=get_google_certs(key_id), audience=GOOGLE_CLIENT_ID)
+    if idinfo.get("iss") not in GOOGLE_ISSUERS:
+        raise ValueError(f"Wrong issuer: {idinfo.get('iss')}")
+    return idinfo
 
 @app.route("/auth/google", methods=["POST"])
 def google_auth():
     token = request.json.get("token")
     try:
-        idinfo = id_token.verify_oauth2_token(
-            token,
-            google_requests.Request(),
-            GOOGLE_CLIENT_ID
-        )
-        print("Google OAuth successful:", idinfo)
+        idinfo = verify_google_token(token)
+        app.logger.debug("Google OAuth successful: %s", idinfo)
         
         user = users_collection.find_one({"email": idinfo["email"]})
         if not user:
@@ -91,12 +236,11 @@ def google_auth():
         
         # Store user email in Flask session (HTTP-only cookie)
         session["user_email"] = user["email"]
-        print("Session after login:", session)
+        app.logger.debug("Session after login: %s", session)
         
-        user["_id"] = str(user["_id"])
         return jsonify({"message": "Login successful", "user": user})
     except Exception as e:
-        print("Google OAuth failed:", str(e))
+        app.logger.info("Google OAuth failed: %s", e)
         return jsonify({"error": str(e)}), 401
 
 # -----------------------------
@@ -111,23 +255,23 @@ def create_watchlist():
     data = request.json
     watchlist_name = data.get("name")
 
-    # Check if a watchlist with the same name already exists
-    existing_watchlist = watchlists_collection.find_one({
-        "user_email": user_email,
-        "name": watchlist_name
-    })
+    # Create the watchlist unless one with the same name already exists,
+    # in a single atomic round-trip
+    result = watchlists_collection.update_one(
+        {"user_email": user_email, "name": watchlist_name},
+        {"$setOnInsert": {"movies": []}},
+        upsert=True
+    )
 
-    if existing_watchlist:
+    if result.upserted_id is None:
         return jsonify({"error": "Watchlist with this name already exists"}), 400
 
-    # Create new watchlist
     watchlist = {
+        "_id": result.upserted_id,
         "name": watchlist_name,
         "user_email": user_email,
         "movies": []
     }
-    result = watchlists_collection.insert_one(watchlist)
-    watchlist["_id"] = str(result.inserted_id)
 
     return jsonify(watchlist)
 
@@ -138,24 +282,28 @@ def add_movie_to_watchlist(watchlist_name):
         return jsonify({"error": "Unauthorized"}), 401
     
     data = request.json
-    result = watchlists_collection.update_one(
+    # Return the updated watchlist so the client doesn't have to fetch it again
+    watchlist = watchlists_collection.find_one_and_update(
         {"name": watchlist_name, "user_email": user_email},
-        {"$push": {"movies": data["movie"]}}
+        {"$push": {"movies": data["movie"]}},
+        return_document=ReturnDocument.AFTER
     )
-    if result.modified_count > 0:
-        return jsonify({"message": "Movie added to watchlist"})
-    return jsonify({"error": "Watchlist not found"}), 404
+    if not watchlist:
+        return jsonify({"error": "Watchlist not found"}), 404
+
+    return jsonify({"message": "Movie added to watchlist", "watchlist": watchlist})
 
 @app.route("/watchlist", methods=["GET"])
 def get_watchlists():
     user_email = session.get("user_email")
-    print("Session:", session)  # Debugging
+    app.logger.debug("Session: %s", session)
     if not user_email:
         return jsonify({"error": "Unauthorized"}), 401
     
-    watchlists = list(watchlists_collection.find({"user_email": user_email}))
-    for watchlist in watchlists:
-        watchlist["_id"] = str(watchlist["_id"])
+    watchlists = list(watchlists_collection.find(
+        {"user_email": user_email},
+        batch_size=LIST_BATCH_SIZE
+    ))
     return jsonify(watchlists)
 
 @app.route("/watchlist/<name>", methods=["GET"])
@@ -164,14 +312,10 @@ def get_watchlist(name):
     if not user_email:
         return jsonify({"error": "Unauthorized"}), 401
     
-    watchlist = watchlists_collection.find_one({
-        "user_email": user_email,
-        "name": name
-    })
+    watchlist = watchlist_loader.load(user_email, name)
     if not watchlist:
         return jsonify({"error": "Watchlist not found"}), 404
     
-    watchlist["_id"] = str(watchlist["_id"])
     return jsonify(watchlist)
 
 # -----------------------------
@@ -190,8 +334,8 @@ def add_journal_entry():
         "entry": data["entry"],
         "date": data["date"]
     }
-    result = journals_collection.insert_one(journal_entry)
-    journal_entry["_id"] = str(result.inserted_id)
+    # insert_one sets journal_entry["_id"]
+    journals_collection.insert_one(journal_entry)
     
     return jsonify(journal_entry)
 
@@ -201,9 +345,11 @@ def get_journal_entries():
     if not user_email:
         return jsonify({"error": "Unauthorized"}), 401
     
-    entries = list(journals_collection.find({"user_email": user_email}))
-    for entry in entries:
-        entry["_id"] = str(entry["_id"])
+    entries = list(journals_collection.find(
+        {"user_email": user_email},
+        projection={"movie_title": 1, "entry": 1, "date": 1},
+        batch_size=LIST_BATCH_SIZE
+    ))
     return jsonify(entries)
 
 
@@ -214,9 +360,10 @@ def get_all_watchlists():
     if not user_email:
         return jsonify({"error": "Unauthorized"}), 401
     
-    watchlists = list(watchlists_collection.find({"user_email": user_email}))
-    for watchlist in watchlists:
-        watchlist["_id"] = str(watchlist["_id"])
+    watchlists = list(watchlists_collection.find(
+        {"user_email": user_email},
+        batch_size=LIST_BATCH_SIZE
+    ))
     
     return jsonify(watchlists)
 
@@ -225,60 +372,176 @@ def get_all_watchlists():
 # -----------------------------
 # 7) WATCHLIST COVER (Optional)
 # -----------------------------
+TMDB_IMAGE_URL = "https://image.tmdb.org/t/p/w500"
+POSTER_SIZE = (500, 750)  # Native size of TMDB's w500 posters, so tiles need no resize
+POSTER_CACHE_TIMEOUT = 7 * 24 * 3600  # Posters never change for a given path
+COVER_CACHE_TIMEOUT = 3600
+# Covers change whenever a movie is added, so browsers must revalidate (cheaply, via ETag)
+COVER_CACHE_CONTROL = "private, no-cache"
+
+# Shared session so poster downloads reuse TCP/TLS connections
+http_session = requests.Session()
+http_session.mount("https://", HTTPAdapter(pool_connections=8, pool_maxsize=8))
+
+# Redis-backed cache for poster bytes and rendered covers (in-process without REDIS_URL)
+cache = Cache(app, config={
+    "CACHE_TYPE": "RedisCache" if os.getenv("REDIS_URL") else "SimpleCache",
+    "CACHE_REDIS_URL": os.getenv("REDIS_URL"),
+    "CACHE_DEFAULT_TIMEOUT": COVER_CACHE_TIMEOUT,
+})
+
+def fetch_posters(poster_paths):
+    """Returns the poster bytes for the given TMDB paths, skipping failed ones.
+
+    Cached posters are served from the cache; the rest are downloaded concurrently.
+    """
+    if not poster_paths:
+        return []
+
+    keys = [f"poster:{path}" for path in poster_paths]
+    contents = cache.get_many(*keys)
+    missing = [i for i, content in enumerate(contents) if content is None]
+    if missing:
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            fetched = list(executor.map(_get_poster, [poster_paths[i] for i in missing]))
+        for i, content in zip(missing, fetched):
+            if content is not None:
+                contents[i] = content
+                cache.set(keys[i], content, timeout=POSTER_CACHE_TIMEOUT)
+
+    return [content for content in contents if content is not None]
+
+def _get_poster(poster_path):
+    url = f"{TMDB_IMAGE_URL}{poster_path}"
+    try:
+        response = http_session.get(url, timeout=10)
+    except requests.RequestException as e:
+        app.logger.warning("Failed to fetch poster %s: %s", url, e)
+        return None
+    return response.content if response.status_code == 200 else None
+
+@functools.lru_cache(maxsize=None)
+def default_cover():
+    """Returns the bytes of the default cover, read from disk once per process."""
+    with open(os.path.join(app.static_folder, "default-cover.jpg"), "rb") as f:
+        return f.read()
+
+def _fit_tile(poster):
+    # Only posters that don't match the TMDB variant size need resizing
+    if poster.size == POSTER_SIZE:
+        return poster
+
+    # BILINEAR is noticeably cheaper than the default BICUBIC at poster size
+    return poster.resize(POSTER_SIZE, Image.BILINEAR)
+
+class IncompleteCover(Exception):
+    """
+    Raised by render_cover when some posters failed to download, so the
+    incomplete result isn't memoized. Carries that result (or None).
+    """
+
+    def __init__(self, cover):
+        super().__init__("Some posters could not be fetched")
+        self.cover = cover
+
+@cache.memoize(timeout=COVER_CACHE_TIMEOUT)
+def render_cover(poster_paths):
+    """
+    Renders the JPEG collage for a tuple of poster paths.
+    Returns None if there are no poster paths, and raises IncompleteCover
+    if any of the posters could not be fetched.
+    """
+    contents = fetch_posters(poster_paths)
+    if len(contents) < len(poster_paths):
+        raise IncompleteCover(build_collage(contents))
+    return build_collage(contents)
+
+def build_collage(contents):
+    """Builds the JPEG collage from the given poster bytes, or None if there are none."""
+    if not contents:
+        return None
+
+    # A single poster is already a JPEG, no need to decode and re-encode it
+    if len(contents) == 1:
+        return contents[0]
+
+    posters = [Image.open(BytesIO(content)) for content in contents]
+
+    # Calculate grid size
+    cols = min(2, len(posters))
+    rows = math.ceil(len(posters) / cols)
+
+    resized = [_fit_tile(poster) for poster in posters]
+
+    collage = Image.new('RGB', (POSTER_SIZE[0]*cols, POSTER_SIZE[1]*rows))
+
+    for i, img in enumerate(resized):
+        row = i // cols
+        col = i % cols
+        collage.paste(img, (col*POSTER_SIZE[0], row*POSTER_SIZE[1]))
+
+    # Single-pass baseline encode with 4:2:0 chroma subsampling is the fastest path
+    img_io = BytesIO()
+    collage.save(img_io, 'JPEG', quality=85, optimize=False, progressive=False, subsampling=2)
+    return img_io.getvalue()
+
 @app.route('/watchlist/<name>/cover')
 def get_watchlist_cover(name):
     """
     Generates a collage from up to the first 4 posters in the watchlist.
     If none, returns a default cover.
     """
-    from flask import send_file
     user_email = session.get("user_email")
     if not user_email:
         return jsonify({"error": "Unauthorized"}), 401
 
-    watchlist = watchlists_collection.find_one({
-        "user_email": user_email,
-        "name": name
-    })
-    if not watchlist:
+    # Holds just the poster paths of the first 4 movies
+    watchlist = cover_loader.load(user_email, name)
+    if watchlist is None:
         return jsonify({"error": "Watchlist not found"}), 404
 
-    posters = []
-    for movie in watchlist["movies"][:4]:  # Get first 4 movies
-        if movie.get("poster_path"):
-            response = requests.get(f"https://image.tmdb.org/t/p/w500{movie['poster_path']}")
-            if response.status_code == 200:
-                posters.append(Image.open(BytesIO(response.content)))
-
-    if not posters:
-        return send_file("static/default-cover.jpg", mimetype='image/jpeg')
-
-    if len(posters) == 1:
-        collage = posters[0]
+    # The collage only depends on the poster paths, so they form the cache key
+    poster_paths = tuple(path for path in watchlist["posters"] if path)
+    etag = hashlib.md5(orjson.dumps(poster_paths)).hexdigest()
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
     else:
-        # Calculate grid size
-        cols = min(2, len(posters))
-        rows = math.ceil(len(posters) / cols)
-
-        poster_size = (600, 900)
-        resized = [poster.resize(poster_size) for poster in posters]
+        try:
+            cover = render_cover(poster_paths)
+        except IncompleteCover as e:
+            # Some posters failed to download; serve what could be fetched, but
+            # without an ETag so it can't be pinned as this cover through 304s
+            response = Response(e.cover or default_cover(), mimetype='image/jpeg')
+            response.headers["Cache-Control"] = "no-store"
+            return response
+        response = Response(cover or default_cover(), mimetype='image/jpeg')
+
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = COVER_CACHE_CONTROL
+    return response
 
-        collage = Image.new('RGB', (poster_size[0]*cols, poster_size[1]*rows))
+@app.route('/watchlist/<name>/posters')
+def get_watchlist_posters(name):
+    """
+    Returns the TMDB URLs of up to the first 4 posters in the watchlist, so
+    the client can lay out the cover itself straight from TMDB's CDN.
+    """
+    user_email = session.get("user_email")
+    if not user_email:
+        return jsonify({"error": "Unauthorized"}), 401
 
-        for i, img in enumerate(resized):
-            row = i // cols
-            col = i % cols
-            collage.paste(img, (col*poster_size[0], row*poster_size[1]))
+    watchlist = cover_loader.load(user_email, name)
+    if watchlist is None:
+        return jsonify({"error": "Watchlist not found"}), 404
 
-    img_io = BytesIO()
-    collage.save(img_io, 'JPEG', quality=85)
-    img_io.seek(0)
-    
-    return send_file(img_io, mimetype='image/jpeg')
+    posters = [f"{TMDB_IMAGE_URL}{path}" for path in watchlist["posters"] if path]
+    return jsonify({"posters": posters})
 
 # -----------------------------
 # 8) MAIN ENTRY
 # -----------------------------
+# Local development only; production runs `gunicorn app:app` (see gunicorn.conf.py)
 if __name__ == "__main__":
+    create_indexes()
     port = int(os.environ.get("PORT", 10000))
-    app.run(host="0.0.0.0", port=port, debug=True)
+    app.run(host="0.0.0.0", port=port, debug=os.getenv("FLASK_DEBUG") == "1")
@@ -0,0 +1,25 @@
+# Gunicorn configuration, loaded automatically by `gunicorn app:app`
+
+# Patch before the app is preloaded so requests, pymongo and the thread pools
+# it creates at import all yield to other greenlets while waiting on I/O.
+from gevent import monkey
+
+monkey.patch_all()
+
+import multiprocessing
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 10000)}"
+workers = int(os.environ.get("WEB_CONCURRENCY", multiprocessing.cpu_count() * 2 + 1))
+worker_class = "gevent"
+worker_connections = 1000
+preload_app = True
+
+
+def post_worker_init(worker):
+    # Nothing touches MongoDB at import (the client uses connect=False), so each
+    # worker opens its own pool here. Ensuring the indexes doubles as the
+    # connection warm-up, so the handshake doesn't land on the first request.
+    from app import create_indexes
+
+    create_indexes()